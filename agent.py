@@ -5,8 +5,10 @@ This module contains the main LangChain orchestrator class that coordinates
 the pipeline of converting user questions into validated SQL queries using
 a graph-based agent workflow with critic review.
 """
+import asyncio
 import re
 import sqlalchemy
+from openai import DefaultAsyncHttpxClient
 from langchain_core.messages import HumanMessage
 from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field
@@ -37,9 +39,11 @@ class LangChain:
         prompt (str): System prompt template with detailed instructions.
         engine: SQLAlchemy engine for database connection and query validation.
         tools (list): List of tool functions available to the agent.
+        checkpointer: Optional LangGraph checkpointer used by the agent graph.
+        stream: Whether the agent streams LLM responses (see Agent), or None for the default.
     """
 
-    def __init__(self, model, sqlite_url):
+    def __init__(self, model, sqlite_url, checkpointer=None, stream=None):
         """
         Initialize the LangChain SQL generation system.
 
@@ -50,6 +54,16 @@ class LangChain:
             model: Language model instance (e.g., ChatOpenAI) supporting tool calling.
             sqlite_url (str): SQLAlchemy connection string for SQLite database.
                              Format: "sqlite:///path/to/database.db"
+            checkpointer (optional): LangGraph checkpointer (e.g. AsyncSqliteSaver from
+                             langgraph-checkpoint-sqlite) passed to every Agent. Each
+                             question is checkpointed under its own thread_id, so a
+                             rerun after a crash resumes instead of starting over.
+                             Defaults to None (no persistence).
+            stream (bool, optional): If True, the agent streams each LLM response with
+                             astream. Streamed responses bypass the LLM cache that
+                             lang_graph sets up, so every call goes to the API. The
+                             default None streams only when no LLM cache is set, i.e.
+                             uses the cache in this repo. Defaults to None.
 
         Note:
             The prompt template includes detailed instructions about:
@@ -62,6 +76,18 @@ class LangChain:
         # Store the language model for later use in SQL generation
         self.model = model
 
+        # Optional checkpointer for resuming interrupted agent runs
+        self.checkpointer = checkpointer
+
+        # Whether the agent streams LLM responses (None: only without an LLM cache)
+        self.stream = stream
+
+        # Copy of the model bound to an HTTP client owned by one event loop,
+        # rebuilt when called from another loop (see _loop_model)
+        self._model_loop = None
+        self._loop_http_client = None
+        self._bound_model = None
+
         # Define Pydantic model for structured output from the LLM
         # This ensures consistent, parseable responses
         class SQLResponse(BaseModel):
@@ -90,14 +116,11 @@ class LangChain:
 
         # Define the comprehensive system prompt template
         # This prompt is critical - it guides the entire SQL generation process
+        # The question is placed last so that everything before it is an identical
+        # prefix for every question, which lets the provider's prompt cache reuse it
         self.prompt = """
             You are an AI assistant that converts natural language questions into SQL queries.
-            To do this, you will be provided with three key pieces of information:
-
-            The actual natural language question to convert into an SQL query:
-            <question>
-            {QUESTION}
-            </question>
+            The natural language question to convert into an SQL query is given at the end.
 
             Follow the instructions below:
             1. Your task is to generate an SQL query that will retrieve the data needed to answer the question, based on the database schema.
@@ -110,6 +133,11 @@ class LangChain:
             7. Follow the rules and return output in the exact JSON structure below.
             Formatting requirements (MANDATORY):
             {format_instructions}
+
+            The actual natural language question to convert into an SQL query:
+            <question>
+            {QUESTION}
+            </question>
         """
 
         # Create SQLAlchemy engine for database connection
@@ -134,6 +162,70 @@ class LangChain:
         """
         Convert a natural language question into a validated SQL query.
 
+        Synchronous wrapper that runs aget_sql in a fresh event loop. Inside an
+        environment that already has a running event loop (e.g. Jupyter), await
+        aget_sql directly instead.
+
+        Args:
+            question (str): Natural language question to convert to SQL.
+
+        Returns:
+            tuple: Same as aget_sql - the final SQL query and token usage metadata.
+        """
+        async def _main():
+            try:
+                return await self.aget_sql(question)
+            finally:
+                # The loop ends with asyncio.run, so release its connections now
+                await self.aclose()
+        return asyncio.run(_main())
+
+    def _loop_model(self):
+        """
+        Return a copy of the model whose async API calls use this event loop's HTTP client.
+
+        ChatOpenAI keeps one async HTTP client for its lifetime, and pooled
+        connections belong to the event loop that opened them, so reusing the
+        model from a later event loop (e.g. successive asyncio.run calls) fails
+        with "Event loop is closed". A copy bound to a fresh client is built per
+        loop. Models without an http_async_client setting are used as is.
+
+        Returns:
+            The model to use for LLM calls on the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._model_loop is not loop:
+            self._bound_model = self.model
+            self._loop_http_client = None
+            if hasattr(self.model, "http_async_client") and hasattr(self.model, "validate_environment"):
+                # Drop the existing async clients so they are rebuilt on the new HTTP client
+                self._loop_http_client = DefaultAsyncHttpxClient()
+                self._bound_model = self.model.model_copy(update={
+                    "http_async_client": self._loop_http_client,
+                    "async_client": None,
+                    "root_async_client": None,
+                })
+                self._bound_model.validate_environment()
+            self._model_loop = loop
+        return self._bound_model
+
+    async def aclose(self):
+        """
+        Close the HTTP client built for the running event loop, if any.
+
+        Call this before an event loop that ran aget_sql ends (get_sql and
+        utils.evaluate do so), so its connections are not leaked. A later
+        aget_sql call builds a new client.
+        """
+        if self._loop_http_client is not None and self._model_loop is asyncio.get_running_loop():
+            http_client = self._loop_http_client
+            self._model_loop = self._loop_http_client = self._bound_model = None
+            await http_client.aclose()
+
+    async def aget_sql(self, question):
+        """
+        Asynchronously convert a natural language question into a validated SQL query.
+
         This is the main entry point for SQL generation. It orchestrates:
         1. Initial SQL generation via LangGraph agent
         2. Multiple extraction strategies to parse SQL from LLM response
@@ -167,22 +259,42 @@ class LangChain:
             format_instructions=self.format_instructions
         )
 
+        # Use the model bound to this event loop's HTTP client
+        model = self._loop_model()
+
         # Create a new agent instance with the formatted prompt
         # Each question gets a fresh agent to avoid state contamination
-        abot = Agent(self.model, self.tools, system=prompt)
+        abot = Agent(model, self.tools, system=prompt,
+                     checkpointer=self.checkpointer, stream=self.stream)
 
         # Create a thread context for this conversation
         # This allows tracking the conversation state across multiple turns
-        thread = {"configurable": {"thread_id": "1"}}
-
-        # Invoke the agent with the initial question
-        # The agent will iteratively call tools until it generates a final response
-        response = abot.graph.invoke(
-            {"messages": [
-                HumanMessage(content=[{"type": "text", "text": question}])
-            ],
-             "thread": thread}
-        )
+        # The question is the thread_id, so checkpoints of different questions never mix
+        thread = {"configurable": {"thread_id": question}}
+
+        # With a checkpointer, pick up any earlier run of this question: return its
+        # answer if it finished (critic review included), resume it if it was
+        # interrupted, or reuse its final state if only the critic stage is missing
+        snapshot = await abot.graph.aget_state(thread) if self.checkpointer else None
+
+        if snapshot and snapshot.values.get("final"):
+            final = snapshot.values["final"]
+            return final["sql"], final["token_usage"]
+
+        if snapshot and snapshot.values.get("messages"):
+            response = (await abot.graph.ainvoke(None, config=thread)
+                        if snapshot.next else snapshot.values)
+        else:
+            # Invoke the agent with the initial question
+            # The agent will iteratively call tools until it generates a final response
+            # The system prompt is seeded as the first message of the state
+            response = await abot.graph.ainvoke(
+                {"messages": abot.with_system([
+                    HumanMessage(content=[{"type": "text", "text": question}])
+                ]),
+                 "thread": thread},
+                config=thread
+            )
 
         # Check if the response indicates a non-SELECT query restriction
         if response.get("messages")[-1].content == "Can only do select queries":
@@ -243,7 +355,7 @@ class LangChain:
 
         # --- Critic Review Stage ---
         # Submit the generated SQL to a critic agent for semantic validation
-        critic_decision = run_critic_review(self.model, question, sql_query)
+        critic_decision = await run_critic_review(model, question, sql_query)
 
         # If critic doesn't approve, regenerate SQL with feedback
         if "approve" not in critic_decision.lower():
@@ -253,11 +365,13 @@ class LangChain:
 
             # Invoke agent again with the original response + critic feedback
             # This gives the agent a chance to fix issues identified by the critic
-            followup = abot.graph.invoke({
-                "messages": response.get("messages") + [
+            # A checkpointed thread already holds the original messages
+            history = [] if self.checkpointer else response.get("messages")
+            followup = await abot.graph.ainvoke({
+                "messages": history + [
                     HumanMessage(content=feedback_msg)],
                 "thread": thread
-            })
+            }, config=thread)
 
             # Re-extract SQL from the regenerated response
             content = followup.get("messages")[-1].content if followup.get(
@@ -275,9 +389,16 @@ class LangChain:
                 if msg:
                     sql_query = msg.group(1).strip()
 
+        token_usage = _token_usage(response.get("messages")[-1])
+
+        # Record the answer in the thread, so a rerun returns it without
+        # sending it through the critic again
+        if self.checkpointer:
+            await abot.graph.aupdate_state(
+                thread, {"final": {"sql": sql_query, "token_usage": token_usage}})
+
         # Return the final SQL query and token usage metadata
-        return sql_query, response.get("messages")[-1].response_metadata.get(
-            "token_usage", {})
+        return sql_query, token_usage
 
     def run_query(self, sql_query):
         """
@@ -314,7 +435,34 @@ class LangChain:
             return result.fetchall()
 
 
-def run_critic_review(model, question: str, sql_string: str) -> str:
+def _token_usage(message) -> dict:
+    """
+    Return the OpenAI-style token usage of an LLM message.
+
+    Invoked responses carry it in response_metadata["token_usage"]. Streamed
+    responses only carry usage_metadata, whose keys are mapped back to the
+    same prompt_tokens/completion_tokens/total_tokens shape.
+
+    Args:
+        message: The AIMessage returned by the agent.
+
+    Returns:
+        dict: Token usage statistics, or an empty dict if none were reported.
+    """
+    token_usage = message.response_metadata.get("token_usage")
+    if token_usage:
+        return token_usage
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
+        return {}
+    return {
+        "prompt_tokens": usage.get("input_tokens", 0),
+        "completion_tokens": usage.get("output_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+    }
+
+
+async def run_critic_review(model, question: str, sql_string: str) -> str:
     """
     Use a separate LLM instance to critique and review generated SQL.
 
@@ -359,7 +507,7 @@ def run_critic_review(model, question: str, sql_string: str) -> str:
 
     # Invoke the critic model with the constructed prompt
     # We use HumanMessage to simulate a user asking for a review
-    resp = model.invoke([HumanMessage(content=prompt)])
+    resp = await model.ainvoke([HumanMessage(content=prompt)])
 
     # Extract the text content from the response and clean whitespace
     # If content is None, use empty string as fallback
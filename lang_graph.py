@@ -4,21 +4,102 @@ LangGraph agent implementation for SQL query generation.
 This module defines the Agent class that orchestrates LLM calls and tool
 executions using a graph-based workflow pattern.
 """
-from typing import TypedDict, Annotated
-import operator
+from typing import TypedDict, Annotated, NotRequired
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import json
+from pathlib import Path
 from langgraph.graph import StateGraph, END
-from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage, ToolMessage
+from langgraph.graph.message import add_messages
+from langchain_core.messages import (AnyMessage, AIMessage, SystemMessage, HumanMessage,
+                                     ToolMessage, RemoveMessage, message_chunk_to_message)
+from langchain_openai.chat_models import ChatOpenAI
+from langchain_core.globals import get_llm_cache, set_llm_cache
+from langchain_community.cache import SQLiteCache
+
+# Cache LLM completions on disk so identical (system, messages) inputs, e.g. when
+# re-running the same questions during development, skip the API call entirely.
+# The file lives next to this module, so the cache is shared regardless of where
+# the script or notebook is run from
+set_llm_cache(SQLiteCache(database_path=str(Path(__file__).resolve().parent / ".lc_cache.db")))
+
+# Thread pool shared by all agents for running tools that only have a blocking
+# implementation. A new Agent is built per question, so a per-agent pool would
+# leave idle threads behind.
+_tool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-tool")
+
+# Once the compactable part of the conversation (everything except the prompt,
+# the question, the latest tool round and the latest VERBATIM_TOOLS results)
+# holds more characters than this (roughly 6000 tokens), it is replaced by a
+# summary before the next LLM call
+COMPACT_THRESHOLD_CHARS = 24000
+
+# Tools whose latest results are never summarized, since the agent needs them exactly
+VERBATIM_TOOLS = ("get_schema",)
+
+# Name given to the summary message that replaces compacted steps
+SUMMARY_NAME = "history_summary"
+
+def _fast_stringify(result):
+    """
+    Convert a tool result into ToolMessage content as compactly as possible.
+
+    Strings are used as is. Dicts, lists and tuples (e.g. schema details or
+    rows returned by a query) are serialized to compact JSON, which is shorter
+    than their Python repr and keeps non-ASCII text unescaped, so fewer prompt
+    tokens are sent on the next LLM hop. Anything else falls back to str().
+
+    Args:
+        result: Value returned by a tool.
+
+    Returns:
+        str: Content for the ToolMessage.
+    """
+    if isinstance(result, str):
+        return result
+    if isinstance(result, (dict, list, tuple)):
+        return json.dumps(result, separators=(',', ':'), ensure_ascii=False, default=str)
+    return str(result)
+
+def _transcript_entry(message):
+    """
+    Render a message as a line of the transcript sent to the summary model.
+
+    AI messages that call tools usually have empty content, and what they
+    tried (e.g. the SQL passed to validate_sql) is only in their tool calls,
+    so each call's name and arguments are included. Tool results are labelled
+    with the tool that produced them.
+
+    Args:
+        message: Message from the agent's history.
+
+    Returns:
+        str: Text of the message, prefixed by its type.
+    """
+    label = message.type
+    if isinstance(message, ToolMessage) and message.name:
+        label = f"{label} ({message.name})"
+    lines = [f"{label}: {message.content}"]
+    for call in getattr(message, "tool_calls", None) or []:
+        lines.append(f"tool call {call['name']}: {_fast_stringify(call['args'])}")
+    return "\n".join(lines)
 
 class AgentState(TypedDict):
     """
     Type definition for the agent's state in the LangGraph workflow.
 
     Attributes:
-        messages (Annotated[list[AnyMessage], operator.add]): List of messages that
-            represents the conversation history. The operator.add annotation means
-            new messages are appended to existing ones rather than replacing them.
+        messages (Annotated[list[AnyMessage], add_messages]): List of messages that
+            represents the conversation history. The add_messages reducer appends new
+            messages to existing ones, replaces a message returned with an existing id,
+            and deletes messages named by a RemoveMessage.
+        final (dict, optional): Final answer recorded by the caller once its own
+            post-processing of the run is done, so a checkpointed thread that is
+            resumed can return it instead of repeating that work.
     """
-    messages: Annotated[list[AnyMessage], operator.add]
+    messages: Annotated[list[AnyMessage], add_messages]
+    final: NotRequired[dict]
 
 class Agent:
     """
@@ -32,15 +113,28 @@ class Agent:
         1. Start at "llm" node - calls the language model
         2. Check if LLM requested tool calls
         3. If yes, go to "action" node - executes tools and returns to "llm"
-        4. If no, end the workflow and return final response
+        4. If the history has grown too long, go through "compact" first, which
+           replaces older steps with a summary
+        5. If no tool calls, end the workflow and return final response
 
     Attributes:
         system (str): System prompt that provides context and instructions to the LLM.
+        _sys_msg (list): The system prompt as a one-element SystemMessage list, or an
+            empty list if no system prompt was given. Built once in __init__.
         graph (CompiledGraph): The compiled LangGraph state machine.
         tools (dict): Dictionary mapping tool names to tool functions.
+        _tool_invokers (dict): Tool name to the tool's bound invoke method.
+        _tool_ainvokers (dict): Tool name to the tool's bound ainvoke method.
+        _async_tools (set[str]): Names of tools with a native async implementation.
+        _executor (ThreadPoolExecutor): Pool that runs the blocking tools.
         model: The LLM with tools bound to it for function calling.
+        stream (bool or None): Whether the LLM response is streamed with astream;
+            None streams only when no LLM cache is configured.
+        summary_model: Model used by compact_history, or None for gpt-4o-mini.
+        compact_threshold (int): Size in characters of the compactable messages that triggers compaction.
     """
-    def __init__(self, model, tools, system=""):
+    def __init__(self, model, tools, system="", checkpointer=None, stream=None,
+                 summary_model=None, compact_threshold=COMPACT_THRESHOLD_CHARS):
         """
         Initialize the agent with model, tools, and optional system prompt.
 
@@ -51,43 +145,124 @@ class Agent:
             model: Language model instance (e.g., ChatOpenAI) that supports tool binding.
             tools (list): List of tool functions/objects that the LLM can call.
             system (str, optional): System prompt providing context to the LLM. Defaults to "".
+            checkpointer (optional): LangGraph checkpointer (e.g. AsyncSqliteSaver) that
+                persists the state after every node, so an interrupted run can be resumed
+                from its thread_id. Defaults to None (no persistence).
+            stream (bool, optional): If True, the LLM response is streamed with astream
+                and the chunks are merged into one message. Streamed completions are never
+                served from the LLM cache, so the default None streams only when no global
+                LLM cache is set and uses ainvoke otherwise. Defaults to None.
+            summary_model (optional): Cheap model used to summarize older steps when the
+                history is compacted. Defaults to None (ChatOpenAI gpt-4o-mini).
+            compact_threshold (int, optional): Size, in characters, of the compactable
+                messages (see _compactable) above which the history is compacted.
+                Defaults to COMPACT_THRESHOLD_CHARS.
 
         Note:
             The graph is compiled immediately upon initialization and stored in self.graph.
         """
-        # Store the system prompt for use in call_openai
+        # Store the system prompt and build its SystemMessage once for use in call_openai
+        # It is always the head of the request, so providers can cache it as a prefix
         self.system = system
+        self._sys_msg = [self._system_message(model, system)] if system else []
+
+        # Whether call_openai streams the LLM response (None: only without an LLM cache)
+        self.stream = stream
+
+        # OpenAI only reports token usage for streams when asked to
+        self._stream_kwargs = ({"stream_usage": True}
+                               if getattr(model, "_llm_type", None) == "openai-chat" else {})
+
+        # Settings for compacting long histories
+        self.summary_model = summary_model
+        self.compact_threshold = compact_threshold
 
         # Initialize the state graph with AgentState type definition
         graph = StateGraph(AgentState)
         # Add the LLM node - this is where the language model processes messages
+        # Both nodes are coroutines, so the graph must be run with ainvoke/astream
         graph.add_node("llm", self.call_openai)
 
         # Add the action node - this is where tools are executed
         graph.add_node("action", self.take_action)
 
+        # Add the compact node - this is where older steps are summarized
+        graph.add_node("compact", self.compact_history)
+
         # Add conditional edges from llm node:
         # - If exists_action returns True, route to "action" node
         # - If exists_action returns False, route to END (finish workflow)
         graph.add_conditional_edges("llm", self.exists_action, {True: "action", False: END})
 
-        # Add unconditional edge from action back to llm
-        # After tools execute, always return to the LLM to process results
-        graph.add_edge("action", "llm")
+        # Add conditional edges from action node:
+        # After tools execute, return to the LLM to process results, going through
+        # "compact" first if the history has grown past the threshold
+        graph.add_conditional_edges("action", self.needs_compaction,
+                                    {True: "compact", False: "llm"})
+        graph.add_edge("compact", "llm")
 
         # Set "llm" as the entry point - workflow always starts here
         graph.set_entry_point("llm")
 
         # Compile the graph into an executable workflow
-        self.graph = graph.compile()
+        # With a checkpointer, state is saved per thread_id after every node
+        self.graph = graph.compile(checkpointer=checkpointer)
 
         # Create a dictionary mapping tool names to tool objects for quick lookup
         self.tools = {tool.name: tool for tool in tools}
 
+        # Bind each tool's invoke/ainvoke method once, so dispatching a tool call
+        # is a single dictionary lookup
+        self._tool_invokers = {name: tool.invoke for name, tool in self.tools.items()}
+        self._tool_ainvokers = {name: tool.ainvoke for name, tool in self.tools.items()}
+
+        # Tools created from a coroutine are awaited directly; all others are
+        # blocking and run on the shared thread pool
+        self._async_tools = {name for name, tool in self.tools.items()
+                             if getattr(tool, "coroutine", None) is not None}
+        self._executor = _tool_executor
+
         # Bind the tools to the model so it knows what functions it can call
         self.model = model.bind_tools(tools)
 
-    def call_openai(self, state: AgentState):
+    @staticmethod
+    def _system_message(model, system):
+        """
+        Build the SystemMessage for the system prompt, marked for prompt caching.
+
+        OpenAI caches long, identical request prefixes automatically. Anthropic only
+        caches content blocks explicitly marked with cache_control, so for Anthropic
+        chat models the prompt is sent as such a block.
+
+        Args:
+            model: Language model instance the prompt will be sent to.
+            system (str): System prompt text.
+
+        Returns:
+            SystemMessage: Message carrying the system prompt.
+        """
+        if getattr(model, "_llm_type", None) == "anthropic-chat":
+            return SystemMessage(content=[{"type": "text", "text": system,
+                                           "cache_control": {"type": "ephemeral"}}])
+        return SystemMessage(content=system)
+
+    def with_system(self, messages):
+        """
+        Build the initial message list for a run, headed by the system prompt.
+
+        Seeding the state this way keeps the SystemMessage at index 0 of the
+        conversation, so call_openai can send state['messages'] without copying
+        the whole (growing) history on every hop.
+
+        Args:
+            messages (list): Messages that start the conversation.
+
+        Returns:
+            list: The system prompt message (if any) followed by messages.
+        """
+        return self._sys_msg + list(messages)
+
+    async def call_openai(self, state: AgentState):
         """
         Node function that invokes the language model with current conversation state.
 
@@ -102,23 +277,33 @@ class Agent:
                  Format: {'messages': [new_message]}
 
         Note:
-            If a system prompt was provided during initialization, it's prepended
-            to the messages before sending to the LLM.
+            If a system prompt was provided during initialization, the history is
+            expected to start with it (see with_system), so it is passed to the LLM
+            as is. Only a history without the system prompt is copied to prepend it.
         """
         # Extract the message history from the current state
         messages = state['messages']
 
-        # If a system prompt exists, prepend it to provide context to the LLM
-        # This ensures the LLM always has its instructions available
-        if self.system:
-            messages = [SystemMessage(content=self.system)] + messages
+        # If a system prompt exists but was not seeded into the state, prepend the
+        # prebuilt SystemMessage so the LLM always has its instructions available
+        if self._sys_msg and not (messages and isinstance(messages[0], SystemMessage)):
+            messages = self._sys_msg + messages
 
         # Invoke the language model with the full message history
         # The model may return a regular response or include tool_calls
-        message = self.model.invoke(messages)
+        stream = self.stream if self.stream is not None else get_llm_cache() is None
+        if stream:
+            # Consume the stream as it arrives and merge the chunks; tool call
+            # arguments are accumulated chunk by chunk
+            final = None
+            async for chunk in self.model.astream(messages, **self._stream_kwargs):
+                final = chunk if final is None else final + chunk
+            message = message_chunk_to_message(final)
+        else:
+            message = await self.model.ainvoke(messages)
 
         # Return the new message wrapped in a dict
-        # The operator.add annotation ensures it gets appended to existing messages
+        # The add_messages reducer ensures it gets appended to existing messages
         return {'messages': [message]}
 
     def exists_action(self, state: AgentState):
@@ -145,48 +330,169 @@ class Agent:
         # If tool_calls list has length > 0, return True to trigger action node
         return len(result.tool_calls) > 0
 
-    def take_action(self, state: AgentState):
+    async def take_action(self, state: AgentState):
         """
         Node function that executes all tool calls requested by the LLM.
 
         When the LLM decides it needs additional information, it includes tool_calls
-        in its response. This function executes each of those tool calls and returns
-        the results as ToolMessages that get added back to the conversation history.
+        in its response. This function executes those tool calls concurrently and
+        returns the results as ToolMessages that get added back to the conversation
+        history.
 
         Args:
             state (AgentState): Current state containing message history with tool calls.
 
         Returns:
-            dict: Updated state with ToolMessage results for each tool call.
+            dict: Updated state with ToolMessage results for each tool call, in the
+                 same order as the tool calls.
                  Format: {'messages': [ToolMessage1, ToolMessage2, ...]}
 
         Note:
             After this node completes, the workflow always returns to the "llm" node
             so the LLM can process the tool results and decide next steps.
+            A tool that raises has its exception reported back as the tool result
+            so the LLM can react to it.
         """
         # Extract tool calls from the most recent LLM message
         tool_calls = state['messages'][-1].tool_calls
 
-        # Initialize list to collect results from all tool executions
-        results = []
-
-        # Execute each tool call sequentially
-        for t in tool_calls:
-            # Look up the tool function by name from the tools dictionary
-            # Invoke the tool with the arguments provided by the LLM
-            result = self.tools[t['name']].invoke(t['args'])
-
-            # Wrap the result in a ToolMessage with metadata
-            # tool_call_id: Links this result back to the specific tool call
-            # name: The name of the tool that was executed
-            # content: The actual result from the tool (converted to string)
-            results.append(ToolMessage(
-                tool_call_id=t['id'],
-                name=t['name'],
-                content=str(result)
-            ))
+        # Look up each tool by name and invoke it with the arguments provided by the LLM
+        # Async tools are awaited on the event loop; blocking tools run on the thread
+        # pool with a copy of the current context (keeps callbacks/tracing intact)
+        loop = asyncio.get_running_loop()
+        awaitables = [
+            self._tool_ainvokers[t['name']](t['args']) if t['name'] in self._async_tools
+            else loop.run_in_executor(self._executor, contextvars.copy_context().run,
+                                      self._tool_invokers[t['name']], t['args'])
+            for t in tool_calls
+        ]
+
+        # All tool calls run concurrently; gather preserves the order of tool_calls
+        raw = await asyncio.gather(*awaitables, return_exceptions=True)
+
+        # Wrap each result in a ToolMessage with metadata
+        # tool_call_id: Links this result back to the specific tool call
+        # name: The name of the tool that was executed
+        # content: The actual result from the tool (compactly serialized to a string)
+        results = [
+            ToolMessage(tool_call_id=t['id'], name=t['name'], content=_fast_stringify(result))
+            for t, result in zip(tool_calls, raw)
+        ]
 
         # Return all tool results wrapped in a dict
         # These messages will be appended to the conversation history
         # and the workflow will loop back to the LLM to process them
-        return {'messages': results}
\ No newline at end of file
+        return {'messages': results}
+
+    @staticmethod
+    def _compactable(messages):
+        """
+        Select the messages that compact_history may summarize.
+
+        Kept verbatim (and therefore excluded) are the system prompt, the first
+        user message, the latest tool round (the last AI message with tool calls
+        and its tool results) and the latest round that called one of
+        VERBATIM_TOOLS. Whole rounds are kept so tool results still follow
+        their call.
+
+        Args:
+            messages (list): Current message history.
+
+        Returns:
+            list: The compactable messages, in history order.
+        """
+        # Keep the system prompt (if seeded) and the first user message
+        head = 1 if messages and isinstance(messages[0], SystemMessage) else 0
+        while head < len(messages) and not isinstance(messages[head], HumanMessage):
+            head += 1
+        protected = set(range(head + 1))
+
+        def _round(start):
+            # An AI message with tool calls followed by its tool results
+            end = start + 1
+            while end < len(messages) and isinstance(messages[end], ToolMessage):
+                end += 1
+            return range(start, end)
+
+        calls = [i for i, m in enumerate(messages) if isinstance(m, AIMessage) and m.tool_calls]
+        if calls:
+            protected.update(_round(calls[-1]))
+        verbatim = [i for i in calls
+                    if any(t['name'] in VERBATIM_TOOLS for t in messages[i].tool_calls)]
+        if verbatim:
+            protected.update(_round(verbatim[-1]))
+
+        return [m for i, m in enumerate(messages) if i not in protected]
+
+    @staticmethod
+    def _only_summary(middle):
+        """
+        Check whether the compactable messages are just an earlier summary.
+
+        Args:
+            middle (list): Messages returned by _compactable.
+
+        Returns:
+            bool: True if there is nothing new to summarize.
+        """
+        return all(isinstance(m, HumanMessage) and m.name == SUMMARY_NAME for m in middle)
+
+    def needs_compaction(self, state: AgentState):
+        """
+        Conditional edge function that determines if the history should be compacted.
+
+        Only the compactable messages (see _compactable) are measured, so large
+        results that are always kept, such as the schema, do not trigger it.
+
+        Args:
+            state (AgentState): Current state containing message history.
+
+        Returns:
+            bool: True if the compactable messages exceed compact_threshold characters
+                 and are not just an earlier summary.
+        """
+        middle = self._compactable(state['messages'])
+        if self._only_summary(middle):
+            return False
+        size = sum(len(m.content) if isinstance(m.content, str) else len(str(m.content))
+                   for m in middle)
+        return size > self.compact_threshold
+
+    async def compact_history(self, state: AgentState):
+        """
+        Node function that replaces older steps of the conversation with a summary.
+
+        The messages selected by _compactable are summarized by a cheap model;
+        everything else is kept verbatim. The summary is a user message (named
+        SUMMARY_NAME) rather than a system message, since some providers, such as
+        Anthropic, only accept a system prompt at the start. It replaces the first
+        summarized message in place and the rest are removed, so every subsequent
+        LLM call sends a bounded history. An earlier summary is folded into the
+        new one.
+
+        Args:
+            state (AgentState): Current state containing message history.
+
+        Returns:
+            dict: Summary message and RemoveMessage entries for the add_messages reducer.
+                 Format: {'messages': [HumanMessage, RemoveMessage, ...]}
+        """
+        middle = self._compactable(state['messages'])
+        if self._only_summary(middle):
+            return {'messages': []}
+
+        # Summarize the older steps with a cheap model
+        transcript = "\n\n".join(_transcript_entry(m) for m in middle)
+        model = self.summary_model or ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        summary = await model.ainvoke([
+            SystemMessage(content="Summarize the following steps of a SQL agent's work as "
+                                  "concise bullet points. Keep table and column names, "
+                                  "SQL tried, errors seen and conclusions reached."),
+            HumanMessage(content=transcript)
+        ])
+
+        # Replace the first summarized message in place and remove the others
+        return {'messages': [
+            HumanMessage(content=f"Summary of earlier steps:\n{summary.content}",
+                         name=SUMMARY_NAME, id=middle[0].id)
+        ] + [RemoveMessage(id=m.id) for m in middle[1:]]}
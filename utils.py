@@ -4,18 +4,118 @@ Utility functions for SQL script execution and query evaluation.
 This module provides helper functions for executing SQL scripts,
 comparing queries, and evaluating SQL generation systems.
 """
-import os
-import time
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import sqlite3
 from pathlib import Path
-from typing import List
-from openai import OpenAI
+from typing import List, Optional
+import httpx
+from openai import (APIConnectionError, APITimeoutError, AsyncOpenAI,
+                    DefaultAsyncHttpxClient, InternalServerError, RateLimitError)
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.normalize_identifiers import normalize_identifiers
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from tqdm.asyncio import tqdm_asyncio
+
+logger = logging.getLogger(__name__)
+
+# Shared AsyncOpenAI client, created on first use so that importing this module
+# does not require OPENAI_API_KEY to be set yet. The client's connection pool
+# belongs to the event loop it was first used on, so it is rebuilt when called
+# from a different loop. The synchronous wrappers close it before their event
+# loop ends (see _run_closing_client), so its connections are not leaked. It
+# talks HTTP/2, so concurrent judge calls are multiplexed over a few TCP/TLS
+# connections.
+_client = None
+_client_loop = None
+
+# Errors worth retrying: rate limits and transient network/server failures.
+# Anything else (bad request, auth, parsing) fails immediately.
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# Exponential backoff (1s, 2s, 4s, ... capped at 16s) for up to 3 attempts. On
+# coroutines tenacity sleeps with asyncio.sleep, so other tasks keep running.
+api_retry = retry(
+    wait=wait_exponential(multiplier=1, max=16),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    reraise=True,
+)
+
+# Persistent cache for LLM responses (judge verdicts, generated SQL), stored
+# next to this module. The connection is opened on first use.
+CACHE_PATH = Path(__file__).resolve().parent / ".judge_cache.db"
+_cache_conn = None
+
+def prepare_sqlite(conn: sqlite3.Connection) -> None:
+    """
+    Configure a SQLite connection for fast bulk loading of SQL scripts.
+
+    Call once right after sqlite3.connect and before execute_sql_script. Sets:
+        - journal_mode=WAL: commits append to a write-ahead log instead of
+          rewriting the rollback journal (persists in the database file).
+        - synchronous=NORMAL: fsync at WAL checkpoints rather than every commit.
+        - temp_store=MEMORY: temporary tables and indices are kept in memory.
+        - cache_size=-64000: page cache of roughly 64 MB.
+        - mmap_size=268435456: read the database through a 256 MB memory map.
+
+    Args:
+        conn (sqlite3.Connection): Connection to configure.
+    """
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-64000;"
+        "PRAGMA mmap_size=268435456;"
+    )
+
+def _split_sql_script(sql_script: str) -> List[tuple]:
+    """
+    Split a SQL script into PRAGMA statements and blocks of ordinary statements.
+
+    Statements are delimited line by line with sqlite3.complete_statement, so
+    semicolons inside string literals do not split a statement.
+
+    Args:
+        sql_script (str): Full contents of a SQL script.
+
+    Returns:
+        List[tuple]: (is_pragma, sql) pairs in script order. Consecutive
+        non-PRAGMA statements are merged into a single block.
+    """
+    parts = []
+    statement = ""
+    for line in sql_script.splitlines(keepends=True):
+        statement += line
+        if not sqlite3.complete_statement(statement):
+            continue
+        is_pragma = statement.lstrip().upper().startswith("PRAGMA")
+        if parts and not is_pragma and not parts[-1][0]:
+            # Extend the current block of ordinary statements
+            parts[-1] = (False, parts[-1][1] + statement)
+        else:
+            parts.append((is_pragma, statement))
+        statement = ""
+    if statement.strip():
+        parts.append((False, statement))
+    return parts
 
 def execute_sql_script(cursor, script_file_path):
     """
     Execute a SQL script file using the provided database cursor.
 
     Reads a SQL script from the SQL_Files directory relative to this module's location
-    and executes it using the cursor's executescript method.
+    and executes it using the cursor's executescript method. Ordinary statements run
+    inside a single transaction, so the database syncs to disk once per block instead
+    of once per statement. PRAGMA statements (e.g. foreign_keys) have no effect inside
+    a transaction, so they are executed between the transactional blocks. If a
+    statement fails, its block is rolled back and the error is re-raised, so the
+    connection is not left inside an open transaction.
 
     Args:
         cursor: Database cursor object with executescript method (e.g., sqlite3.Cursor).
@@ -28,23 +128,272 @@ def execute_sql_script(cursor, script_file_path):
 
     # Construct the full path to the SQL file by joining base directory with SQL_Files folder
     # and the provided script file name
-    sql_file = os.path.join(base_dir, "SQL_Files", script_file_path)
+    sql_file = Path(base_dir, "SQL_Files", script_file_path)
+
+    # Load the entire script with an explicit encoding (no locale detection)
+    sql_script = sql_file.read_text(encoding="utf-8")
+
+    for is_pragma, sql in _split_sql_script(sql_script):
+        if is_pragma:
+            cursor.executescript(sql)
+        else:
+            # Wrap the block in one explicit transaction
+            try:
+                cursor.executescript(f"BEGIN;\n{sql}\nCOMMIT;")
+            except Exception:
+                # Undo the partial block before surfacing the error
+                if cursor.connection.in_transaction:
+                    cursor.execute("ROLLBACK")
+                raise
+
+def _strip_sql(sql: str) -> str:
+    """
+    Cheaply canonicalize a SQL query: no surrounding whitespace or trailing semicolon.
+
+    Nothing else is touched, since case and inner whitespace may belong to
+    string literals (name='Bob' vs name='bob', n='a  b' vs n='a b'); formatting
+    differences are left to normalize_sql.
+
+    Args:
+        sql (str): SQL query.
+
+    Returns:
+        str: Stripped form of the query.
+    """
+    return sql.strip().rstrip(";").rstrip()
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql: str) -> str:
+    """
+    Normalize a SQL query so that trivially different spellings compare equal.
+
+    The query is parsed with sqlglot and regenerated in a canonical form:
+    keyword case, whitespace, comments and a trailing semicolon no longer
+    matter, and identifiers are lower-cased and unquoted, so "t" matches t.
+    The result is only meant for comparison; unquoted keywords or spaces in
+    identifiers may make it invalid SQL. Queries sqlglot cannot
+    parse fall back to stripping and lower-casing. Results are memoized, since
+    the same reference queries are normalized on every evaluation run.
+
+    Args:
+        sql (str): SQL query to normalize.
+
+    Returns:
+        str: Canonical form of the query.
+    """
+    try:
+        tree = normalize_identifiers(sqlglot.parse_one(sql, read="sqlite"), dialect="sqlite")
+        # Drop identifier quoting so quoted and bare names compare equal
+        for identifier in tree.find_all(exp.Identifier):
+            identifier.set("quoted", False)
+        return tree.sql(dialect="sqlite", normalize=True, comments=False)
+    except Exception:
+        return sql.strip().lower()
+
+def sql_matches(sql1: str, sql2: str) -> bool:
+    """
+    Check whether two SQL queries are the same query up to formatting.
+
+    Compares the cheap stripped forms first and only parses with sqlglot
+    (normalize_sql) when those differ.
+
+    Args:
+        sql1 (str): The first SQL query.
+        sql2 (str): The second SQL query.
+
+    Returns:
+        bool: True if the queries match after normalization.
+    """
+    return (_strip_sql(sql1) == _strip_sql(sql2)
+            or normalize_sql(sql1) == normalize_sql(sql2))
+
+def _get_cache() -> sqlite3.Connection:
+    """
+    Return the connection to the persistent response cache, creating it if needed.
+
+    Returns:
+        sqlite3.Connection: Connection to the SQLite file at CACHE_PATH.
+    """
+    global _cache_conn
+    if _cache_conn is None:
+        _cache_conn = sqlite3.connect(CACHE_PATH)
+        _cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    return _cache_conn
+
+def _cache_key(*parts: str) -> str:
+    """
+    Build a cache key from the given strings using a BLAKE2b hash.
+
+    Args:
+        *parts (str): Strings identifying the cached call. They are joined with a
+            NUL separator so that ("ab", "c") and ("a", "bc") get different keys.
+
+    Returns:
+        str: Hex digest used as the primary key in the cache table.
+    """
+    return hashlib.blake2b("\0".join(parts).encode("utf-8")).hexdigest()
+
+def _cache_get(key: str):
+    """
+    Look up a JSON-encoded value in the response cache.
+
+    Args:
+        key (str): Key produced by _cache_key.
+
+    Returns:
+        The decoded value, or None if the key is not cached.
+    """
+    row = _get_cache().execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def _cache_set(key: str, value) -> None:
+    """
+    Store a JSON-serializable value in the response cache.
+
+    Args:
+        key (str): Key produced by _cache_key.
+        value: Value to store; must be JSON-serializable.
+    """
+    conn = _get_cache()
+    conn.execute("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                 (key, json.dumps(value)))
+    conn.commit()
+
+# The only verdicts a judge may return besides "Error"; anything else the model
+# says (e.g. a sentence cut short by max_tokens) is treated as an error
+VERDICTS = ("Equivalent", "Not Equivalent")
+
+def _parse_verdict(text) -> str:
+    """
+    Map a judge reply onto one of VERDICTS, or "Error" if it is not one.
+
+    Surrounding whitespace, quotes and periods are ignored, as is letter case.
+
+    Args:
+        text: Reply of the LLM judge.
+
+    Returns:
+        str: "Equivalent", "Not Equivalent" or "Error".
+    """
+    reply = str(text or "").strip().strip('"\'.').strip().lower()
+    return next((verdict for verdict in VERDICTS if verdict.lower() == reply), "Error")
+
+def _judge_cache_key(nlq: str, sql1: str, sql2: str) -> str:
+    """
+    Build the cache key for a judge verdict on (nlq, sql1, sql2).
+
+    Args:
+        nlq (str): The natural language question.
+        sql1 (str): The first SQL query; stripped (see _strip_sql) for the key.
+        sql2 (str): The second SQL query; stripped (see _strip_sql) for the key.
+
+    Returns:
+        str: Key for the response cache.
+    """
+    # Case is kept, so queries differing only in a literal's case get their own verdict
+    return _cache_key("judge", nlq, _strip_sql(sql1), _strip_sql(sql2))
+
+def cached_judge(fn):
+    """
+    Decorator that caches the verdicts of an async SQL judge on disk.
+
+    The judge is a pure function of the question and the two queries, so its
+    verdict is stored under a hash of (nlq, sql1, sql2), with the queries
+    stripped. Repeated evaluation runs then skip the LLM call
+    for pairs that were already judged. Only verdicts in VERDICTS are cached,
+    so errors and malformed replies are judged again next time.
+
+    Args:
+        fn: Coroutine function with the signature (nlq, sql1, sql2) -> str.
+
+    Returns:
+        Coroutine function with the same signature that consults the cache first.
+    """
+    @functools.wraps(fn)
+    async def wrapper(nlq: str, sql1: str, sql2: str) -> str:
+        key = _judge_cache_key(nlq, sql1, sql2)
+        cached = _cache_get(key)
+        if cached in VERDICTS:
+            return cached
+        decision = await fn(nlq, sql1, sql2)
+        if decision in VERDICTS:
+            _cache_set(key, decision)
+        return decision
+    return wrapper
 
-    # Open the SQL file in read mode and load its entire contents
-    with open(sql_file, 'r') as file:
-        sql_script = file.read()
+def _get_client() -> AsyncOpenAI:
+    """
+    Return the module-level AsyncOpenAI client for the running event loop.
+
+    Returns:
+        AsyncOpenAI: Client reused across judge calls made on the same event loop.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        # API key is read from the OPENAI_API_KEY environment variable
+        # DefaultAsyncHttpxClient keeps the SDK's default timeouts and redirects
+        _client = AsyncOpenAI(http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        ))
+        _client_loop = loop
+    return _client
+
+async def _close_client() -> None:
+    """
+    Close the shared AsyncOpenAI client and release its connection pool.
+
+    Does nothing if no client exists or it belongs to a different event loop.
+    """
+    global _client, _client_loop
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        client, _client, _client_loop = _client, None, None
+        await client.close()
+
+def _run_closing_client(coro):
+    """
+    Run a coroutine in a fresh event loop, closing the shared client before the loop ends.
+
+    A client's connection pool can only be closed on the loop it was used on, so
+    it is closed here rather than when the next loop replaces it.
+
+    Args:
+        coro: Coroutine to run.
+
+    Returns:
+        The coroutine's result.
+    """
+    async def _main():
+        try:
+            return await coro
+        finally:
+            await _close_client()
+    return asyncio.run(_main())
+
+@api_retry
+async def _create_completion(**kwargs):
+    """
+    Create a chat completion on the shared client, retrying transient API errors.
+
+    Args:
+        **kwargs: Arguments passed to chat.completions.create.
 
-    # Execute the entire SQL script at once using executescript
-    # This method can handle multiple SQL statements separated by semicolons
-    cursor.executescript(sql_script)
+    Returns:
+        ChatCompletion: The API response.
+    """
+    return await _get_client().chat.completions.create(**kwargs)
 
-def judge_sql_similarity(nlq: str, sql1: str, sql2: str) -> str:
+@cached_judge
+async def judge_sql_similarity(nlq: str, sql1: str, sql2: str) -> str:
     """
     Use an LLM to judge whether two SQL queries are semantically equivalent.
 
     Sends a prompt to GPT-4o to determine if two SQL queries would produce similar results
     for a given natural language question. The judgment allows for minor differences like
     extra columns (e.g., ID fields) but identifies substantive differences in query intent.
+    Verdicts are cached on disk (see cached_judge).
 
     Args:
         nlq (str): The natural language question that prompted the SQL queries.
@@ -77,115 +426,379 @@ def judge_sql_similarity(nlq: str, sql1: str, sql2: str) -> str:
             Are the queries equivalent?
             """
     try:
-        # Initialize OpenAI client (API key should be set in environment variables)
-        client = OpenAI()
-
         # Make API call to GPT-4o model with the constructed prompt
         # Temperature=0 ensures deterministic, consistent responses
-        resp = client.chat.completions.create(
+        resp = await _create_completion(
             model="gpt-4o",  # Using GPT-4o for high-quality judgments
             messages=[{"role": "user", "content": prompt}],
             temperature=0,  # Deterministic output for consistency
+            max_tokens=4,  # The verdict is at most a few tokens; stop decoding there
         )
 
-        # Extract the decision from the response and remove any leading/trailing whitespace
-        decision = resp.choices[0].message.content.strip()
+        # Extract the decision from the response; anything but a verdict
+        # (e.g. a sentence truncated by max_tokens) counts as an error
+        decision = _parse_verdict(resp.choices[0].message.content)
+        if decision == "Error":
+            logger.error("LLM judge returned an unexpected reply: %r",
+                         resp.choices[0].message.content)
 
         return decision
     except Exception as err:
         # If any error occurs during the API call, log it and return "Error"
-        print(f"[Error] LLM judge failed: {err}")
+        logger.error("LLM judge failed: %s", err)
         return "Error"
 
-def evaluate(sql_helper, test_cases) -> List[dict]:
+def judge_sql_similarity_sync(nlq: str, sql1: str, sql2: str) -> str:
+    """
+    Synchronous wrapper around judge_sql_similarity for callers outside an event loop.
+
+    Args:
+        nlq (str): The natural language question that prompted the SQL queries.
+        sql1 (str): The first SQL query to compare.
+        sql2 (str): The second SQL query to compare.
+
+    Returns:
+        str: "Equivalent", "Not Equivalent" or "Error", see judge_sql_similarity.
+    """
+    return _run_closing_client(judge_sql_similarity(nlq, sql1, sql2))
+
+async def judge_batch(triples: List[tuple], max_concurrency: int = 4) -> List[str]:
+    """
+    Judge several (question, query, query) triples with a single LLM call.
+
+    All triples that are not already in the response cache are numbered and sent
+    to GPT-4o in one prompt, which answers with a JSON list of verdicts. This turns
+    one round trip per test case into one round trip per batch. If the batched
+    response cannot be parsed, the affected triples fall back to individual
+    judge_sql_similarity calls, at most max_concurrency at a time. If the batch
+    failed with an API error that survived its retries (e.g. a rate limit), the
+    triples are marked "Error" instead, since more requests would only make it worse.
+
+    Args:
+        triples (List[tuple]): (nlq, sql1, sql2) triples, as for judge_sql_similarity.
+        max_concurrency (int, optional): Maximum number of individual fallback calls
+            in flight at the same time. Defaults to 4.
+
+    Returns:
+        List[str]: One verdict per triple, in the same order. Each verdict is
+        "Equivalent", "Not Equivalent" or "Error".
+    """
+    # Serve already-judged triples from the cache
+    verdicts = [_cache_get(_judge_cache_key(*triple)) for triple in triples]
+    pending = [i for i, verdict in enumerate(verdicts) if verdict not in VERDICTS]
+    if not pending:
+        return verdicts
+
+    # Number each pair so the model can answer them in order
+    pairs = "\n".join(
+        f"""
+            Pair {n}:
+            User Question: {triples[i][0]}
+            Query 1:
+            {triples[i][1]}
+            Query 2:
+            {triples[i][2]}
+            """
+        for n, i in enumerate(pending, start=1))
+    prompt = f"""
+            You are a SQL expert. For each of the following {len(pending)} pairs, a user asked a question, and two SQL queries were generated in response. Judge if both queries are equivalent in meaning and would produce the similar result. If there are extra columns like ID column etc. that is fine. When executed, they should produce a similar result. For instance, if the question is to fetch all doctor names, then getting doctor names with Doctor ID is fine but getting the appointments of doctors is not correct.
+
+            Respond ONLY with a JSON object of the form {{"verdicts": [...]}}, where the list holds exactly one entry per pair, in order, and each entry is either "Equivalent" or "Not Equivalent".
+            {pairs}
+            """
+    try:
+        # JSON mode guarantees a parseable object in the response
+        resp = await _create_completion(
+            model="gpt-4o",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            response_format={"type": "json_object"},
+            # Room for the JSON wrapper plus a short verdict per pair
+            max_tokens=16 + 8 * len(pending),
+        )
+        batch_verdicts = json.loads(resp.choices[0].message.content)["verdicts"]
+        if len(batch_verdicts) != len(pending):
+            raise ValueError(
+                f"expected {len(pending)} verdicts, got {len(batch_verdicts)}")
+        for i, verdict in zip(pending, batch_verdicts):
+            # Only well-formed verdicts are kept and cached
+            verdict = _parse_verdict(verdict)
+            verdicts[i] = verdict
+            if verdict in VERDICTS:
+                _cache_set(_judge_cache_key(*triples[i]), verdict)
+    except RETRYABLE_ERRORS as err:
+        # The API is still failing after api_retry; do not multiply the requests
+        logger.error("Batched LLM judge failed: %s", err)
+        for i in pending:
+            verdicts[i] = "Error"
+    except Exception as err:
+        # Fall back to judging each pair on its own, a few at a time
+        logger.warning("Batched LLM judge failed: %s. Judging pairs individually...", err)
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _judge_one(triple):
+            async with sem:
+                return await judge_sql_similarity(*triple)
+
+        fallback = await asyncio.gather(*[_judge_one(triples[i]) for i in pending])
+        for i, verdict in zip(pending, fallback):
+            verdicts[i] = verdict
+
+    return verdicts
+
+def _open_results_db(path: str) -> sqlite3.Connection:
+    """
+    Open (and create if needed) the SQLite file that stores evaluation results.
+
+    Args:
+        path (str): Path to the SQLite database file.
+
+    Returns:
+        sqlite3.Connection: Connection with a `results` table keyed by question.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        "question TEXT PRIMARY KEY, expected_sql TEXT, generated_sql TEXT, "
+        "exact_match INTEGER, llm_judged_equivalent TEXT)")
+    return conn
+
+def _load_result(conn: sqlite3.Connection, nlq: str, expected_sql: str) -> Optional[dict]:
+    """
+    Fetch the stored result of a test case from a previous evaluation run.
+
+    Args:
+        conn (sqlite3.Connection): Connection returned by _open_results_db.
+        nlq (str): The natural language question of the test case.
+        expected_sql (str): The reference SQL; a stored result for a different
+            reference query is treated as stale and ignored.
+
+    Returns:
+        dict or None: The result dictionary (its verdict is None if the case was not
+        judged yet), or None if the case must be (re)generated.
+    """
+    row = conn.execute(
+        "SELECT generated_sql, exact_match, llm_judged_equivalent FROM results "
+        "WHERE question = ? AND expected_sql = ?", (nlq, expected_sql)).fetchone()
+    if row is None:
+        return None
+    return {
+        "question": nlq,
+        "expected_sql": expected_sql,
+        "generated_sql": row[0],
+        "exact_match": bool(row[1]),
+        "llm_judged_equivalent": row[2]
+    }
+
+def _save_result(conn: sqlite3.Connection, result: dict) -> None:
+    """
+    Persist a test case result so later runs can skip the work already done.
+
+    Called right after SQL generation (with no verdict yet for non-exact matches)
+    and again once the judge has answered. A stored row without a verdict is
+    reused on resume and only sent to the judge. Results with a generation error
+    are not stored, and an "Error" verdict is stored as no verdict, so that work
+    is retried on the next run.
+
+    Args:
+        conn (sqlite3.Connection): Connection returned by _open_results_db.
+        result (dict): Result dictionary as produced by evaluate_async.
+    """
+    if result.get("error"):
+        return
+    verdict = result["llm_judged_equivalent"]
+    conn.execute(
+        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+        (result["question"], result["expected_sql"], result["generated_sql"],
+         int(result["exact_match"]), None if verdict == "Error" else verdict))
+    conn.commit()
+
+async def evaluate_async(sql_helper, test_cases, max_concurrency: int = 10,
+                         cache_generated_sql: bool = False,
+                         judge_batch_size: int = 20,
+                         results_db: Optional[str] = None) -> List[dict]:
     """
-    Evaluate a SQL generation system against a set of test cases.
+    Evaluate a SQL generation system against a set of test cases concurrently.
 
     Runs each test case through the SQL helper, compares generated SQL with expected SQL
-    using both exact matching and LLM-based semantic judgment. Includes retry logic for
-    resilience against temporary API failures.
+    using both exact matching and LLM-based semantic judgment. Test cases are processed
+    concurrently with asyncio.gather, and a semaphore caps the number of cases in flight
+    so the APIs are not flooded. Once all SQL is generated, the cases that are not an
+    exact match are judged in batches (see judge_batch). Rate limits and transient
+    API failures are retried with exponential backoff (see api_retry).
 
     Args:
-        sql_helper: Object with a get_sql(nlq: str) method that generates SQL from natural
-                    language questions. Should return a tuple/list where first element is
-                    the generated SQL string.
+        sql_helper: Object with an async aget_sql(nlq: str) method that generates SQL from
+                    natural language questions. Should return a tuple/list where first
+                    element is the generated SQL string. Helpers with only a synchronous
+                    get_sql(nlq: str) are also accepted; their calls run in worker threads.
         test_cases (list): List of dictionaries, each containing:
             - 'question' (str): Natural language question.
             - 'actual_query' (str): Expected/reference SQL query.
+        max_concurrency (int, optional): Maximum number of test cases processed at the
+            same time, and of judge batches sent at the same time. Defaults to 10.
+        cache_generated_sql (bool, optional): If True, SQL generated for a question is
+            stored in the on-disk response cache and reused on later runs, skipping
+            generation entirely. Leave off while iterating on sql_helper itself.
+            Defaults to False.
+        judge_batch_size (int, optional): Maximum number of query pairs sent to the
+            LLM judge in a single call. Defaults to 20.
+        results_db (str, optional): Path to a SQLite file where each test case is saved
+            as soon as its SQL is generated, and again once it is judged. Cases stored
+            there are not generated again and only unjudged ones go to the judge, so an
+            interrupted evaluation can be resumed. Defaults to None (nothing is persisted).
 
     Returns:
-        List[dict]: List of result dictionaries, one per test case, containing:
+        List[dict]: List of result dictionaries, one per test case and in the same order
+        as test_cases, containing:
             - 'question' (str): The natural language question.
             - 'expected_sql' (str): The reference SQL query.
             - 'generated_sql' (str or None): The generated SQL query, or None if error.
-            - 'exact_match' (bool): Whether generated SQL exactly matches expected SQL.
+            - 'exact_match' (bool): Whether generated SQL matches expected SQL after
+              normalization (see sql_matches).
             - 'llm_judged_equivalent' (str or None): LLM judgment if not exact match.
             - 'error' (str, optional): Error message if generation failed.
     """
-    # Initialize empty list to store evaluation results for all test cases
-    results = []
+    # Limit the number of test cases that hit the APIs at the same time
+    sem = asyncio.Semaphore(max_concurrency)
+
+    # Results of a previous, possibly interrupted, run
+    conn = _open_results_db(results_db) if results_db else None
 
-    # Iterate through each test case in the provided list
-    for case in test_cases:
-        # Wait 2 seconds before processing to avoid hitting API rate limits
-        time.sleep(2)
+    @api_retry
+    async def _generate_sql(nlq):
+        # Reuse SQL generated on a previous run when caching is enabled
+        key = _cache_key("sql", nlq)
+        if cache_generated_sql:
+            cached = _cache_get(key)
+            if cached is not None:
+                return cached
+        if hasattr(sql_helper, "aget_sql"):
+            generated_sql = await sql_helper.aget_sql(nlq)
+        else:
+            # Synchronous helpers run in a worker thread so the event loop stays free
+            generated_sql = await asyncio.to_thread(sql_helper.get_sql, nlq)
+        if cache_generated_sql and generated_sql and generated_sql[0]:
+            _cache_set(key, list(generated_sql))
+        return generated_sql
 
+    async def _run_case(case, sem):
         nlq = case['question']
-        print(nlq)  # Print question for progress tracking
+        logger.debug("Evaluating: %s", nlq)
 
         expected_sql = case['actual_query']
 
-        try:
-            # First attempt: Try to generate SQL from the natural language question
+        # Reuse test cases generated by a previous run; stored cases that still
+        # lack a verdict are picked up by the judge pass below
+        if conn is not None:
+            stored = _load_result(conn, nlq, expected_sql)
+            if stored is not None:
+                return stored
+
+        async with sem:
             try:
-                generated_sql = sql_helper.get_sql(nlq)
+                # Generate SQL from the natural language question
+                # Rate limits and transient API errors are retried with backoff
+                generated_sql = await _generate_sql(nlq)
+
+                # Check if SQL generation returned a valid result
+                # The helper should return a tuple/list where first element is the SQL string
+                if not generated_sql or not generated_sql[0]:
+                    raise ValueError("Agent returned no SQL.")
+
+                # Queries that only differ in formatting count as an exact match,
+                # which spares an LLM judge call
+                exact_match = sql_matches(generated_sql[0], expected_sql)
+
+                # Return successful evaluation result; the LLM judgment (only used if
+                # exact match fails) is filled in by the batched judge pass below
+                result = {
+                    "question": nlq,
+                    "expected_sql": expected_sql,
+                    "generated_sql": generated_sql[0],
+                    "exact_match": exact_match,
+                    "llm_judged_equivalent": None
+                }
+                # Save the generated SQL right away, so it survives a crash before
+                # the judge pass; an exact match needs no judgment and is finished
+                if conn is not None:
+                    _save_result(conn, result)
+                return result
+
             except Exception as err:
-                # If first attempt fails, log error and retry after 4 seconds
-                print(f"[evaluate] Error occurred: {err}. Sleeping 4s and retrying once...")
-                time.sleep(4)
-                generated_sql = sql_helper.get_sql(nlq)
-
-            # Check if SQL generation returned a valid result
-            # The helper should return a tuple/list where first element is the SQL string
-            if not generated_sql or not generated_sql[0]:
-                raise ValueError("Agent returned no SQL.")
-
-            exact_match = generated_sql[0].strip().lower() == expected_sql.strip().lower()
-
-            # Initialize LLM judgment as None (only used if exact match fails)
-            llm_judgment = None
-
-            # If queries don't match exactly, use LLM to judge semantic equivalence
-            if not exact_match:
-                try:
-                    # First attempt to get LLM judgment
-                    llm_judgment = judge_sql_similarity(nlq, expected_sql, generated_sql[0])
-                except Exception as err:
-                    # If LLM judge fails, retry after 4 seconds
-                    print(f"[judge] Error: {err}. Sleeping 4s and retrying once...")
-                    time.sleep(4)
-                    llm_judgment = judge_sql_similarity(nlq, expected_sql, generated_sql[0])
-
-            # Append successful evaluation result to results list
-            results.append({
-                "question": nlq,
-                "expected_sql": expected_sql,
-                "generated_sql": generated_sql[0],
-                "exact_match": exact_match,
-                "llm_judged_equivalent": llm_judgment
-            })
-
-        except Exception as err:
-            # If all attempts fail, log the error and add a failure record
-            print(f"[evaluate] Skipped due to error after retry: {err}")
-            results.append({
-                "question": nlq,
-                "expected_sql": expected_sql,
-                "generated_sql": None,  # No SQL was generated
-                "exact_match": False,  # Cannot match if generation failed
-                "llm_judged_equivalent": None,  # Cannot judge if no SQL generated
-                "error": str(err)  # Include error message for debugging
-            })
-
-    # Return the complete list of evaluation results
-    return results
\ No newline at end of file
+                # If all attempts fail, log the error and return a failure record
+                logger.warning("Skipped %r due to error: %s", nlq, err)
+                return {
+                    "question": nlq,
+                    "expected_sql": expected_sql,
+                    "generated_sql": None,  # No SQL was generated
+                    "exact_match": False,  # Cannot match if generation failed
+                    "llm_judged_equivalent": None,  # Cannot judge if no SQL generated
+                    "error": str(err)  # Include error message for debugging
+                }
+
+    # Run all test cases concurrently; gather preserves the order of test_cases
+    # Progress is shown as a single tqdm bar rather than a line per question
+    results = await tqdm_asyncio.gather(*[_run_case(case, sem) for case in test_cases],
+                                        desc="Evaluating", unit="case")
+
+    # Collect the cases that need an LLM judgment and judge them in batches
+    pending = [i for i, result in enumerate(results)
+               if result["generated_sql"] is not None and not result["exact_match"]
+               and result["llm_judged_equivalent"] is None]
+    chunks = [pending[i:i + judge_batch_size]
+              for i in range(0, len(pending), judge_batch_size)]
+    # Batches share the semaphore and fall back to one call at a time, so at most
+    # max_concurrency judge calls are in flight
+    async def _judge_chunk(chunk):
+        async with sem:
+            return await judge_batch([(results[i]["question"], results[i]["expected_sql"],
+                                       results[i]["generated_sql"]) for i in chunk],
+                                     max_concurrency=1)
+
+    judged = await asyncio.gather(*[_judge_chunk(chunk) for chunk in chunks])
+
+    # Write the verdicts back to their test cases by index
+    for chunk, verdicts in zip(chunks, judged):
+        for i, verdict in zip(chunk, verdicts):
+            results[i]["llm_judged_equivalent"] = verdict
+            if conn is not None:
+                _save_result(conn, results[i])
+
+    if conn is not None:
+        conn.close()
+
+    return results
+
+def evaluate(sql_helper, test_cases, max_concurrency: int = 10,
+             cache_generated_sql: bool = False,
+             judge_batch_size: int = 20,
+             results_db: Optional[str] = None) -> List[dict]:
+    """
+    Synchronous entry point for evaluate_async.
+
+    Runs evaluate_async in a fresh event loop. Inside an environment that already
+    has a running event loop (e.g. Jupyter), await evaluate_async directly instead.
+    If sql_helper has an async aclose() method (e.g. agent.LangChain), it is called
+    before the loop ends so the helper's connections are released.
+
+    Args:
+        sql_helper: See evaluate_async.
+        test_cases (list): See evaluate_async.
+        max_concurrency (int, optional): See evaluate_async. Defaults to 10.
+        cache_generated_sql (bool, optional): See evaluate_async. Defaults to False.
+        judge_batch_size (int, optional): See evaluate_async. Defaults to 20.
+        results_db (str, optional): See evaluate_async. Defaults to None.
+
+    Returns:
+        List[dict]: One result dictionary per test case, see evaluate_async.
+    """
+    async def _main():
+        try:
+            return await evaluate_async(sql_helper, test_cases, max_concurrency,
+                                        cache_generated_sql, judge_batch_size,
+                                        results_db)
+        finally:
+            if hasattr(sql_helper, "aclose"):
+                await sql_helper.aclose()
+    return _run_closing_client(_main())